@@ -104,7 +104,7 @@ def Kapowarr() -> None:
 
 		# Create download folder if needed
 		logging.debug('Creating download folder if needed')
-		makedirs(settings.cache['download_folder'], exist_ok=True)
+		makedirs(settings.get_settings()['download_folder'], exist_ok=True)
 
 	# Now that database is setup, start handlers
 	download_handler.load_download_thread.start()
@@ -114,11 +114,11 @@ def Kapowarr() -> None:
 	logging.debug('Creating server')
 	server = create_server(
 		app,
-		host=settings.cache['host'],
-		port=settings.cache['port'],
+		host=settings.get_settings()['host'],
+		port=settings.get_settings()['port'],
 		threads=private_settings['hosting_threads']
 	)
-	logging.info(f'Kapowarr running on http://{settings.cache["host"]}:{settings.cache["port"]}{settings.cache["url_base"]}/')
+	logging.info(f'Kapowarr running on http://{settings.get_settings()["host"]}:{settings.get_settings()["port"]}{settings.get_settings()["url_base"]}/')
 	# Below is run endlessly until CTRL+C
 	server.run()
 
@@ -313,6 +313,8 @@ def setup_db() -> None:
 				issue_id
 			)
 		);
+		CREATE INDEX IF NOT EXISTS issues_files_issue_index
+			ON issues_files(issue_id, file_id);
 		CREATE TABLE IF NOT EXISTS download_queue(
 			id INTEGER PRIMARY KEY,
 			link TEXT NOT NULL,
@@ -4,17 +4,19 @@
 """
 
 import logging
-from os import listdir
-from os.path import basename, dirname, isdir, isfile, join, splitext
-from re import IGNORECASE, compile, escape, match
+from collections import defaultdict
+from functools import lru_cache
+from os import scandir
+from os.path import basename, dirname, isfile, join, splitext
+from re import IGNORECASE, compile
 from string import Formatter
-from typing import Dict, List
+from typing import Callable, Dict, List, Set
 
 from backend.custom_exceptions import (InvalidSettingValue, IssueNotFound,
                                        VolumeNotFound)
 from backend.db import get_db
 from backend.files import image_extensions, rename_file
-from backend.settings import Settings
+from backend.settings import settings
 
 formatting_keys = (
 	'series_name',
@@ -35,6 +37,7 @@ issue_formatting_keys = formatting_keys + (
 filename_cleaner = compile(r'(<|>|:|\"|\||\?|\*|\x00|(\s|\.)+$)')
 page_regex = compile(r'^(\d+)$|page[\s\.\-]?(\d+)', IGNORECASE)
 page_regex_2 = compile(r'(\d+)')
+parse_format = Formatter().parse
 
 #=====================
 # Name generation
@@ -51,6 +54,50 @@ def _make_filename_safe(unsafe_filename: str) -> str:
 	safe_filename = filename_cleaner.sub('', unsafe_filename)
 	return safe_filename
 
+def _build_volume_formatting(volume_data: dict) -> dict:
+	"""Build the values of the formatting keys for a volume
+
+	Args:
+		volume_data (dict): The comicvine_id, title, year, publisher and volume_number of the volume
+
+	Returns:
+		dict: The formatting keys and their values for the volume
+	"""
+	if volume_data.get('title').startswith('The '):
+		clean_title = volume_data.get('title') + ', The'
+	elif volume_data.get('title').startswith('A '):
+		clean_title = volume_data.get('title') + ', A'
+	else:
+		clean_title = volume_data.get('title') or 'Unknown'
+	
+	formatting_data = {
+		'series_name': (volume_data.get('title') or 'Unknown').replace('/', '').replace(r'\\', ''),
+		'clean_series_name': clean_title.replace('/', '').replace(r'\\', ''),
+		'volume_number': volume_data.get('volume_number') or 'Unknown',
+		'comicvine_id': volume_data.get('comicvine_id') or 'Unknown',
+		'year': volume_data.get('year') or 'Unknown',
+		'publisher': volume_data.get('publisher') or 'Unknown'
+	}
+	return formatting_data
+
+def _augment_with_issue(formatting_data: dict, issue_data: dict) -> dict:
+	"""Add the values of the issue formatting keys to the formatting data of a volume
+
+	Args:
+		formatting_data (dict): The formatting data of the volume (output of naming._build_volume_formatting())
+		issue_data (dict): The comicvine_id, issue_number, title and date of the issue
+
+	Returns:
+		dict: A copy of the formatting data with the issue keys and their values added
+	"""
+	return {
+		**formatting_data,
+		'issue_comicvine_id': issue_data.get('comicvine_id') or 'Unknown',
+		'issue_number': issue_data.get('issue_number') or 'Unknown',
+		'issue_title': (issue_data.get('title') or 'Unknown').replace('/', '').replace(r'\\', ''),
+		'issue_release_date': issue_data.get('date') or 'Unknown'
+	}
+
 def _get_formatting_data(volume_id: int, issue_id: int=None) -> dict:
 	"""Get the values of the formatting keys for a volume or issue
 
@@ -79,24 +126,8 @@ def _get_formatting_data(volume_id: int, issue_id: int=None) -> dict:
 	
 	if not volume_data:
 		raise VolumeNotFound
-	volume_data = dict(volume_data)
 	
-	# Build formatted data
-	if volume_data.get('title').startswith('The '):
-		clean_title = volume_data.get('title') + ', The'
-	elif volume_data.get('title').startswith('A '):
-		clean_title = volume_data.get('title') + ', A'
-	else:
-		clean_title = volume_data.get('title') or 'Unknown'
-	
-	formatting_data = {
-		'series_name': (volume_data.get('title') or 'Unknown').replace('/', '').replace(r'\\', ''),
-		'clean_series_name': clean_title.replace('/', '').replace(r'\\', ''),
-		'volume_number': volume_data.get('volume_number') or 'Unknown',
-		'comicvine_id': volume_data.get('comicvine_id') or 'Unknown',
-		'year': volume_data.get('year') or 'Unknown',
-		'publisher': volume_data.get('publisher') or 'Unknown'
-	}
+	formatting_data = _build_volume_formatting(dict(volume_data))
 	
 	if issue_id:
 		# Add issue data if issue is found
@@ -111,53 +142,100 @@ def _get_formatting_data(volume_id: int, issue_id: int=None) -> dict:
 		
 		if not issue_data:
 			raise IssueNotFound
-		issue_data = dict(issue_data)
-			
-		formatting_data.update({
-			'issue_comicvine_id': issue_data.get('comicvine_id') or 'Unknown',
-			'issue_number': issue_data.get('issue_number') or 'Unknown',
-			'issue_title': (issue_data.get('title') or 'Unknown').replace('/', '').replace(r'\\', ''),
-			'issue_release_date': issue_data.get('date') or 'Unknown'
-		})
+		
+		formatting_data = _augment_with_issue(formatting_data, dict(issue_data))
 		
 	return formatting_data
 
-def generate_volume_folder_name(volume_id: int) -> str:
+@lru_cache(maxsize=16)
+def _compile_format(format: str) -> Callable[[dict], str]:
+	"""Parse a format string once into a function that fills it in
+
+	Args:
+		format (str): The format string
+
+	Returns:
+		Callable[[dict], str]: Function that takes the formatting keys and their values and returns the filled in format string
+	"""
+	plan = []
+	for literal, key, spec, conversion in parse_format(format):
+		if key is not None and (conversion or '{' in spec or not key.isidentifier()):
+			# Leave conversions and nested fields to str.format()
+			return lambda formatting_data: format.format(**formatting_data)
+		plan.append((literal, key, spec))
+	plan = tuple(plan)
+
+	def fill(formatting_data: dict) -> str:
+		return ''.join(
+			literal if key is None
+			else literal + formatting_data[key].__format__(spec)
+			for literal, key, spec in plan
+		)
+
+	return fill
+
+@lru_cache(maxsize=16)
+def _needs_issue_data(format: str) -> bool:
+	"""Check if a format string uses any of the issue specific formatting keys
+
+	Args:
+		format (str): The format string
+
+	Returns:
+		bool: Whether or not the issue data is needed to fill in the format string
+	"""
+	return any(
+		key in issue_formatting_keys and not key in formatting_keys
+		for _, key, _, _ in parse_format(format)
+	)
+
+def _generate_name(format: str, formatting_data: dict) -> str:
+	"""Fill in a format string and make the result filesystem-safe
+
+	Args:
+		format (str): The format string
+		formatting_data (dict): The formatting keys and their values
+
+	Returns:
+		str: The name
+	"""
+	name = _compile_format(format)(formatting_data)
+	save_name = _make_filename_safe(name)
+	return save_name
+
+def generate_volume_folder_name(volume_id: int, format: str=None) -> str:
 	"""Generate a volume folder name based on the format string
 
 	Args:
 		volume_id (int): The id of the volume for which to generate the string
+		format (str, optional): The format string to use instead of the one in the settings. Defaults to None.
 
 	Returns:
 		str: The volume folder name
 	"""
 	formatting_data = _get_formatting_data(volume_id)
-	format: str = Settings().get_settings()['volume_folder_naming']
+	format = format or settings.get_settings()['volume_folder_naming']
+	return _generate_name(format, formatting_data)
 
-	name = format.format(**formatting_data)
-	save_name = _make_filename_safe(name)
-	return save_name
-
-def generate_tpb_name(volume_id: int) -> str:
+def generate_tpb_name(volume_id: int, format: str=None) -> str:
 	"""Generate a TPB name based on the format string
 
 	Args:
 		volume_id (int): The id of the volume for which to generate the string
+		format (str, optional): The format string to use instead of the one in the settings. Defaults to None.
 
 	Returns:
 		str: The TPB name
 	"""
 	formatting_data = _get_formatting_data(volume_id)
-	format: str = Settings().get_settings()['file_naming_tpb']
-
-	name = format.format(**formatting_data)
-	save_name = _make_filename_safe(name)
-	return save_name
+	format = format or settings.get_settings()['file_naming_tpb']
+	return _generate_name(format, formatting_data)
 
 def generate_issue_range_name(
 	volume_id: int,
 	calculated_issue_number_start: float,
-	calculated_issue_number_end: float
+	calculated_issue_number_end: float,
+	format: str=None
 ) -> str:
 	"""Generate an issue range name based on the format string
 
@@ -165,55 +243,49 @@ def generate_issue_range_name(
 		volume_id (int): The id of the volume of the issues
 		calculated_issue_number_start (float): The start of the issue range (output of files.process_issue_number())
 		calculated_issue_number_end (float): The end of the issue range (output of files.process_issue_number())
+		format (str, optional): The format string to use instead of the one in the settings. Defaults to None.
 
 	Returns:
 		str: The issue range name
 	"""
-	cursor = get_db()
-	issue_id = cursor.execute("""
-		SELECT id
-		FROM issues
-		WHERE volume_id = ?
-			AND calculated_issue_number = ?
-		LIMIT 1;
-	""", (volume_id, calculated_issue_number_start)).fetchone()[0]
-	formatting_data = _get_formatting_data(volume_id, issue_id)
-	format: str = Settings().get_settings()['file_naming']
-	
-	# Override issue number to range
-	issue_number_start, issue_number_end = cursor.execute("""
-		SELECT issue_number
+	format = format or settings.get_settings()['file_naming']
+	if not _needs_issue_data(format):
+		return _generate_name(format, _get_formatting_data(volume_id))
+
+	issues = get_db().execute("""
+		SELECT id, issue_number
 		FROM issues
 		WHERE
 			volume_id = ?
-			AND
-			(
-				calculated_issue_number = ?
-				OR calculated_issue_number = ?
-			)
-		ORDER BY calculated_issue_number
-		LIMIT 2;
+			AND calculated_issue_number IN (?, ?)
+		ORDER BY calculated_issue_number;
 		""",
 		(volume_id,
 		calculated_issue_number_start,
 		calculated_issue_number_end)
 	).fetchall()
-	formatting_data['issue_number'] = f'{issue_number_start[0]}-{issue_number_end[0]}'
+	formatting_data = _get_formatting_data(volume_id, issues[0][0])
 	
-	name = format.format(**formatting_data)
-	save_name = _make_filename_safe(name)
-	return save_name
+	# Override issue number to range
+	formatting_data['issue_number'] = f'{issues[0][1]}-{issues[-1][1]}'
+	
+	return _generate_name(format, formatting_data)
 
-def generate_issue_name(volume_id: int, calculated_issue_number: float) -> str:
+def generate_issue_name(volume_id: int, calculated_issue_number: float, format: str=None) -> str:
 	"""Generate a issue name based on the format string
 
 	Args:
 		volume_id (int): The id of the volume of the issue
 		calculated_issue_number (float): The issue number (output of files.process_issue_number())
+		format (str, optional): The format string to use instead of the one in the settings. Defaults to None.
 
 	Returns:
 		str: The issue name
 	"""	
+	format = format or settings.get_settings()['file_naming']
+	if not _needs_issue_data(format):
+		return _generate_name(format, _get_formatting_data(volume_id))
+
 	issue_id = get_db().execute("""
 		SELECT id
 		FROM issues
@@ -222,37 +294,49 @@ def generate_issue_name(volume_id: int, calculated_issue_number: float) -> str:
 		LIMIT 1;
 	""", (volume_id, calculated_issue_number)).fetchone()[0]
 	formatting_data = _get_formatting_data(volume_id, issue_id)
-	format: str = Settings().get_settings()['file_naming']
-
-	name = format.format(**formatting_data)
-	save_name = _make_filename_safe(name)
-	return save_name
+	return _generate_name(format, formatting_data)
 
 #=====================
 # Checking formats
 #=====================
-def check_format(format: str, type: str) -> None:
+@lru_cache(maxsize=64)
+def _is_valid_format(format: str, type: str) -> bool:
 	"""Check if a format string is valid
 
 	Args:
 		format (str): The format string to check
 		type (str): What type of format string it is ('file_naming', 'file_naming_tpb', 'folder_naming')
 
-	Raises:
-		InvalidSettingValue: Something in the string is invalid
-	"""	
-	keys = [fn for _, fn, _, _ in Formatter().parse(format) if fn is not None]
+	Returns:
+		bool: Whether or not the format string is valid
+	"""
+	keys = [fn for _, fn, _, _ in parse_format(format) if fn is not None]
 
 	if type in ('file_naming', 'file_naming_tpb'):
 		naming_keys = issue_formatting_keys if type == 'file_naming' else formatting_keys
 		if r'/' in format or r'\\' in format:
-			raise InvalidSettingValue(type, format)
+			return False
 	else:
 		naming_keys = formatting_keys
 
 	for format_key in keys:
 		if not format_key in naming_keys:
-			raise InvalidSettingValue(type, format)
+			return False
+
+	return True
+
+def check_format(format: str, type: str) -> None:
+	"""Check if a format string is valid
+
+	Args:
+		format (str): The format string to check
+		type (str): What type of format string it is ('file_naming', 'file_naming_tpb', 'folder_naming')
+
+	Raises:
+		InvalidSettingValue: Something in the string is invalid
+	"""	
+	if not _is_valid_format(format, type):
+		raise InvalidSettingValue(type, format)
 
 	return
 
@@ -261,47 +345,36 @@ def check_format(format: str, type: str) -> None:
 #=====================
 def same_name_indexing(
 	suggested_name: str,
-	current_name: str,
-	folder: str,
-	planned_names: List[Dict[str, str]]
+	current_basename: str,
+	existing_names: Set[str],
+	planned_names: Set[str]
 ) -> str:
 	"""Add a number after a filename if the filename already exists.
 
 	Args:
 		suggested_name (str): The currently suggested filename
-		current_name (str): The current name of the file
-		folder (str): The folder that the file is in
-		planned_names (List[Dict[str, str]]): The already planned names of other files
+		current_basename (str): The current name of the file, without folder and extension
+		existing_names (Set[str]): The names of the entries in the dest folder, without extension
+		planned_names (Set[str]): The already planned names of other files, without folder and extension
 
 	Returns:
 		str: The suggested name, now with number at the end if needed
 	"""
-	same_names = tuple(
-		filter(
-			lambda r: match(escape(suggested_name) + r'( \(\d+\))?$', r),
-			[splitext(basename(r['after']))[0] for r in planned_names]
+	# Add number to filename if an other file in the dest folder
+	# or an other planned file has the same name
+	i = 0
+	indexed_name = suggested_name
+	while (
+		indexed_name in planned_names
+		or (
+			indexed_name in existing_names
+			and not indexed_name == current_basename
 		)
-	)
-	if isdir(folder):
-		# Add number to filename if an other file in the dest folder has the same name
-		basename_file = splitext(basename(current_name))[0]
-		same_names += tuple(
-			filter(
-				lambda f: not f == basename_file and match(escape(suggested_name) + r'(?: \(\d+\))?$', f),
-				[splitext(f)[0] for f in listdir(folder)]
-			)
-		)
-	if same_names:
-		i = 0
-		while True:
-			if not i and not suggested_name in same_names:
-				break
-			if i and not f"{suggested_name} ({i})" in same_names:
-				suggested_name += f" ({i})"
-				break
-			i += 1
-
-	return suggested_name
+	):
+		i += 1
+		indexed_name = f"{suggested_name} ({i})"
+
+	return indexed_name
 
 def preview_mass_rename(volume_id: int, issue_id: int=None, filepath_filter: List[str]=None) -> List[Dict[str, str]]:
 	"""Preview what naming.mass_rename() will do.
@@ -315,7 +388,26 @@ def preview_mass_rename(volume_id: int, issue_id: int=None, filepath_filter: Lis
 		List[Dict[str, str]]: The renaming proposals.
 	"""
 	result = []
+	setting_values = settings.get_settings()
+	volume_folder_naming: str = setting_values['volume_folder_naming']
+	file_naming: str = setting_values['file_naming']
+	file_naming_tpb: str = setting_values['file_naming_tpb']
+	file_naming_needs_issue = _needs_issue_data(file_naming)
+
 	cursor = get_db('dict')
+	volume_data = cursor.execute("""
+		SELECT
+			comicvine_id,
+			title, year, publisher,
+			volume_number
+		FROM volumes
+		WHERE id = ?
+		LIMIT 1;
+	""", (volume_id,)).fetchone()
+	if not volume_data:
+		raise VolumeNotFound
+	volume_formatting = _build_volume_formatting(dict(volume_data))
+
 	# Fetch all files linked to the volume or issue
 	if not issue_id:
 		file_infos = cursor.execute("""
@@ -327,7 +419,8 @@ def preview_mass_rename(volume_id: int, issue_id: int=None, filepath_filter: Lis
 			ON
 				i.id = if.issue_id
 				AND if.file_id = f.id
-			WHERE i.volume_id = ?;
+			WHERE i.volume_id = ?
+			ORDER BY f.id;
 			""",
 			(volume_id,)
 		).fetchall()
@@ -342,7 +435,13 @@ def preview_mass_rename(volume_id: int, issue_id: int=None, filepath_filter: Lis
 			""",
 			(volume_id,)
 		).fetchone()[0]
-		folder = join(root_folder, generate_volume_folder_name(volume_id))
+		folder = join(
+			root_folder,
+			_generate_name(
+				volume_folder_naming,
+				volume_formatting
+			)
+		)
 	else:
 		file_infos = cursor.execute("""
 			SELECT
@@ -357,68 +456,137 @@ def preview_mass_rename(volume_id: int, issue_id: int=None, filepath_filter: Lis
 		if not file_infos: return result
 		folder = dirname(file_infos[0]['filepath'])
 		
+	# List the dest folder once instead of per file. When it does not
+	# exist yet, there is nothing in it that could clash.
+	try:
+		folder_entries = {e.name: e.is_file() for e in scandir(folder)}
+	except (FileNotFoundError, NotADirectoryError):
+		folder_entries = {}
+	existing_names = {splitext(f)[0] for f in folder_entries}
+
 	if filepath_filter is not None:
 		file_infos = filter(lambda f: f['filepath'] in filepath_filter, file_infos)
 
-	issues_in_volume = cursor.execute(
-		"SELECT COUNT(*) FROM issues WHERE volume_id = ?",
-		(volume_id,)
-	).fetchone()[0]
-	for file in file_infos:
-		# Determine what issue(s) the file covers
-		if not isfile(file['filepath']):
-			continue
-		logging.debug(f'Renaming: original filename: {file["filepath"]}')
-		
-		# Find the issues that the file covers
-		issues = cursor.execute("""
+	issues_data = {
+		issue['id']: dict(issue)
+		for issue in cursor.execute("""
 			SELECT
-				calculated_issue_number
+				id, comicvine_id,
+				issue_number,
+				title, date
 			FROM issues
-			INNER JOIN issues_files
-			ON id = issue_id
-			WHERE file_id = ?
-			ORDER BY calculated_issue_number;
+			WHERE volume_id = ?;
 			""",
-			(file['id'],)
+			(volume_id,)
 		).fetchall()
+	}
+	issues_in_volume = len(issues_data)
+
+	# Find the issues that the files cover
+	if not issue_id:
+		file_ids_query = """
+			SELECT if2.file_id
+			FROM issues_files if2
+			INNER JOIN issues i2
+			ON i2.id = if2.issue_id
+			WHERE i2.volume_id = ?
+		"""
+		file_ids_param = volume_id
+	else:
+		file_ids_query = """
+			SELECT file_id
+			FROM issues_files
+			WHERE issue_id = ?
+		"""
+		file_ids_param = issue_id
+
+	# Only the ids are needed, so skip building a dict for every row
+	file_issues = defaultdict(list)
+	for file_id, file_issue_id in get_db().execute(f"""
+		SELECT if.file_id, if.issue_id
+		FROM issues i
+		INNER JOIN issues_files if
+		ON i.id = if.issue_id
+		WHERE if.file_id IN ({file_ids_query})
+		ORDER BY if.file_id, i.calculated_issue_number;
+		""",
+		(file_ids_param,)
+	):
+		file_issues[file_id].append(file_issue_id)
+
+	planned_names = set()
+	for file in file_infos:
+		filepath: str = file['filepath']
+		file_name = basename(filepath)
+		file_basename, file_extension = splitext(file_name)
+
+		# Determine what issue(s) the file covers
+		if dirname(filepath) == folder:
+			file_exists = folder_entries.get(file_name, False)
+		else:
+			file_exists = isfile(filepath)
+		if not file_exists:
+			continue
+		logging.debug(f'Renaming: original filename: {filepath}')
+		
+		issues = file_issues[file['id']]
 		if len(issues) > 1:
 			if len(issues) == issues_in_volume:
 				# File is TPB
-				suggested_name = generate_tpb_name(volume_id)
+				suggested_name = _generate_name(
+					file_naming_tpb,
+					volume_formatting
+				)
+			elif not file_naming_needs_issue:
+				suggested_name = _generate_name(file_naming, volume_formatting)
 			else:
 				# File covers multiple issues
-				suggested_name = generate_issue_range_name(volume_id, issues[0][0], issues[-1][0])
+				issue_data_start = issues_data[issues[0]]
+				issue_data_end = issues_data[issues[-1]]
+				formatting_data = _augment_with_issue(volume_formatting, issue_data_start)
+				formatting_data['issue_number'] = f'{issue_data_start["issue_number"]}-{issue_data_end["issue_number"]}'
+				suggested_name = _generate_name(
+					file_naming,
+					formatting_data
+				)
+		elif not file_naming_needs_issue:
+			suggested_name = _generate_name(file_naming, volume_formatting)
 		else:
 			# File covers one issue
-			suggested_name = generate_issue_name(volume_id, issues[0][0])
+			suggested_name = _generate_name(
+				file_naming,
+				_augment_with_issue(volume_formatting, issues_data[issues[0]])
+			)
 
 		# If file is image, it's probably a page instead of a whole issue/tpb.
 		# So put it in it's own folder together with the other images.
-		if file['filepath'].endswith(image_extensions):
+		if filepath.endswith(image_extensions):
 			page_number = None
-			page_result = page_regex.search(file['filepath'])
+			page_result = page_regex.search(filepath)
 			if page_result:
 				page_number = next(r for r in page_result.groups() if r is not None)
 			else:
 				page_result = None
-				r = page_regex_2.finditer(file['filepath'])
+				r = page_regex_2.finditer(filepath)
 				for page_result in r: pass
 				if page_result:
 					page_number = page_result.group(1)
 			suggested_name = join(suggested_name, page_number or '1')
 
 		# Add number to filename if other file has the same name
-		suggested_name = same_name_indexing(suggested_name, file['filepath'], folder, result)
+		suggested_name = same_name_indexing(
+			suggested_name, file_basename, existing_names, planned_names
+		)
 
-		suggested_name = join(folder, suggested_name + splitext(file["filepath"])[1])
+		suggested_name = join(folder, suggested_name + file_extension)
 		logging.debug(f'Renaming: suggested filename: {suggested_name}')
-		if file['filepath'] != suggested_name:
+		if filepath != suggested_name:
 			logging.debug(f'Renaming: added rename')
 			result.append({
-				'before': file['filepath'],
+				'before': filepath,
 				'after': suggested_name
 			})
+			planned_names.add(splitext(basename(suggested_name))[0])
 		
 	return result
 
@@ -442,11 +610,16 @@ def mass_rename(volume_id: int, issue_id: int=None, filepath_filter: List[str]=N
 			"UPDATE volumes SET folder = ? WHERE id = ?",
 			(folder, volume_id)
 		)
-	for r in renames:
-		rename_file(r['before'], r['after'])
-		cursor.execute(
+	updates = []
+	try:
+		for r in renames:
+			rename_file(r['before'], r['after'])
+			updates.append((r['after'], r['before']))
+	finally:
+		# Also register the files that were renamed before a failure
+		cursor.executemany(
 			"UPDATE files SET filepath = ? WHERE filepath = ?;",
-			(r['after'], r['before'])
+			updates
 		)
 	logging.info(f'Renamed volume {volume_id} {f"issue {issue_id}" if issue_id else ""}')
 	return
@@ -8,7 +8,9 @@ from os import urandom
 from os.path import isdir
 from os.path import sep as path_sep
 from sys import version_info
-from typing import List
+from threading import Lock
+from types import MappingProxyType
+from typing import Any, List, Mapping
 
 from backend.custom_exceptions import (FolderNotFound, InvalidSettingKey,
                                        InvalidSettingModification,
@@ -69,30 +71,64 @@ supported_source_strings = (('mega', 'mega link'),
 							('mediafire', 'mediafire link'),
 							('getcomics', 'download now','main server','mirror download','link 1','link 2'))
 
+# Read-only snapshot of the settings. It's never modified in place,
+# only replaced as a whole, so readers don't need the lock.
+_cache_lock = Lock()
+_cache: Mapping[str, Any] = MappingProxyType({})
+
+def _refresh_cache() -> Mapping[str, Any]:
+	"""Replace the settings cache with the values in the database
+
+	Returns:
+		Mapping[str, Any]: The new settings cache
+	"""
+	global _cache
+	with _cache_lock:
+		settings = dict(get_db().execute(
+			"SELECT key, value FROM config;"
+		))
+		settings['unzip'] = settings['unzip'] == 1
+		_cache = MappingProxyType(settings)
+	return _cache
+
+def _update_cache(changes: dict) -> Mapping[str, Any]:
+	"""Replace the settings cache with a copy that has the changes applied
+
+	Args:
+		changes (dict): The keys and new values of the settings that changed
+
+	Returns:
+		Mapping[str, Any]: The new settings cache
+	"""
+	global _cache
+	if not _cache:
+		return _refresh_cache()
+
+	with _cache_lock:
+		settings = {**_cache, **changes}
+		if 'unzip' in changes:
+			settings['unzip'] = settings['unzip'] == 1
+		_cache = MappingProxyType(settings)
+	return _cache
+
 class Settings:
 	"""For interacting with the settings
 	"""	
-	cache = {}
-	
-	def get_settings(self, use_cache: bool=True) -> dict:
+	def get_settings(self, use_cache: bool=True) -> Mapping[str, Any]:
 		"""Get all settings and their values
 
 		Args:
 			use_cache (bool, optional): Wether or not to use the cache instead of going to the database. Defaults to True.
 
 		Returns:
-			dict: All settings and their values
+			Mapping[str, Any]: All settings and their values (read-only)
 		"""		
-		if not use_cache or not self.cache:
-			settings = dict(get_db().execute(
-				"SELECT key, value FROM config;"
-			))
-			settings['unzip'] = settings['unzip'] == 1
-			self.cache.update(settings)
+		if not use_cache or not _cache:
+			return _refresh_cache()
 
-		return self.cache
+		return _cache
 
-	def set_settings(self, settings: dict) -> dict:
+	def set_settings(self, settings: dict) -> Mapping[str, Any]:
 		"""Change the values of settings
 
 		Args:
@@ -105,7 +141,7 @@ class Settings:
 			InvalidSettingKey: The key isn't recognised
 
 		Returns:
-			dict: The settings and their new values. Same format as settings.Settings.get_settings()
+			Mapping[str, Any]: The settings and their new values. Same format as settings.Settings.get_settings()
 		"""		
 		from backend.naming import check_format
 
@@ -148,14 +184,14 @@ class Settings:
 			if 'log_level' in settings:
 				set_log_level(settings['log_level'])
 
-			result = self.get_settings(use_cache=False)
+			result = _update_cache({k: v for v, k in setting_changes})
 		else:
 			result = self.get_settings()
 		logging.info(f'Settings changed: {", ".join(str(s[1]) + "->" + str(s[0]) for s in setting_changes)}')
 
 		return result
 
-	def reset_setting(self, key: str) -> dict:
+	def reset_setting(self, key: str) -> Mapping[str, Any]:
 		"""Reset a setting's value
 
 		Args:
@@ -165,7 +201,7 @@ class Settings:
 			InvalidSettingKey: The key isn't recognised
 
 		Returns:
-			dict: The settings and their new values. Same format as settings.Settings.get_settings()
+			Mapping[str, Any]: The settings and their new values. Same format as settings.Settings.get_settings()
 		"""		
 		logging.debug(f'Setting reset: {key}')
 		if not key in default_settings:
@@ -178,11 +214,11 @@ class Settings:
 		logging.info(f'Setting reset: {key}->{default_settings[key]}')
 		return self.get_settings(use_cache=False)
 		
-	def generate_api_key(self) -> dict:
+	def generate_api_key(self) -> Mapping[str, Any]:
 		"""Generate a new api key
 
 		Returns:
-			dict: The settings and their new value. Same format as settings.Settings.get_settings()
+			Mapping[str, Any]: The settings and their new value. Same format as settings.Settings.get_settings()
 		"""		
 		logging.debug('Generating new api key')
 		api_key = urandom(16).hex()
@@ -227,3 +263,5 @@ class Settings:
 		cursor.connection.isolation_level = ""
 
 		return
+
+settings = Settings()
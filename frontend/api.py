@@ -27,7 +27,7 @@ from backend.download import (DownloadHandler, credentials,
 from backend.naming import mass_rename, preview_mass_rename
 from backend.root_folders import RootFolders
 from backend.search import manual_search
-from backend.settings import Settings, about_data, blocklist_reasons
+from backend.settings import about_data, blocklist_reasons, settings
 from backend.tasks import (TaskHandler, delete_task_history, get_task_history,
                            get_task_planning, task_library)
 from backend.volumes import Library, search_volumes, ui_vars
@@ -35,7 +35,6 @@ from backend.volumes import Library, search_volumes, ui_vars
 api = Blueprint('api', __name__)
 root_folders = RootFolders()
 library = Library()
-settings = Settings()
 
 # Create handlers
 handler_context = Flask('handler')
@@ -273,24 +272,24 @@ def api_task(task_id: int):
 @auth
 def api_settings():
 	if request.method == 'GET':
-		result = settings.get_settings()
+		result = dict(settings.get_settings())
 		return return_api(result)
 
 	elif request.method == 'PUT':
 		data = request.get_json()
-		result = settings.set_settings(data)
+		result = dict(settings.set_settings(data))
 		return return_api(result)
 
 	elif request.method == 'DELETE':
 		key = extract_key(request, 'key')
-		result = settings.reset_setting(key)
+		result = dict(settings.reset_setting(key))
 		return return_api(result)
 
 @api.route('/settings/api_key', methods=['POST'])
 @error_handler
 @auth
 def api_settings_api_key():
-	result = settings.generate_api_key()
+	result = dict(settings.generate_api_key())
 	return return_api(result)
 
 @api.route('/settings/servicepreference', methods=['GET', 'PUT'])